@@ -1,33 +1,72 @@
 from flask import Flask
-import os
-from dotenv import load_dotenv
+from sqlalchemy.engine import make_url
+from .config import settings
 
-load_dotenv()
 
+def _engine_options(database_url: str, statement_timeout: bool = True) -> dict:
+    """SQLAlchemy engine options (pool tuning for PostgreSQL/psycopg2)"""
+    options = {
+        'pool_pre_ping': True,  # Drop connections the server has closed
+        'pool_recycle': 1800,
+    }
+    
+    if make_url(database_url).drivername in ('postgresql', 'postgresql+psycopg2'):
+        options.update({
+            'pool_size': 20,
+            'max_overflow': 10,
+            'executemany_mode': 'values_plus_batch',
+        })
+        if statement_timeout:
+            options['connect_args'] = {'options': '-c statement_timeout=5000'}
+    
+    return options
 
-def create_app():
-    app = Flask(__name__)
 
-    # Database configuration
-    database_url = os.getenv('DATABASE_URL', 'sqlite:///punctual.db')
+def create_app(warm_directions: bool = True, statement_timeout: bool = True):
+    """
+    Build the Flask app
     
-    # Render PostgreSQL uses 'postgres://' but SQLAlchemy needs 'postgresql://'
-    if database_url and database_url.startswith('postgres://'):
-        database_url = database_url.replace('postgres://', 'postgresql://', 1)
+    Args:
+        warm_directions: Build the Directions client up front (off for
+            processes that never calculate routes, like the scheduler)
+        statement_timeout: Cap PostgreSQL statements at 5 seconds (off for
+            schema changes and backfills in init_db.py)
+    """
+    app = Flask(__name__)
     
-    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    # orjson for request parsing and jsonify()
+    from .json_provider import OrjsonProvider
+    app.json = OrjsonProvider(app)
+
+    # Database configuration
+    app.config['SQLALCHEMY_DATABASE_URI'] = settings.database_url
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = _engine_options(settings.database_url, statement_timeout)
 
     # Initialize SQLAlchemy
     from .models import db
     db.init_app(app)
 
+    # Short-lived response cache (set CACHE_TYPE=RedisCache for multi-worker deploys)
+    from .cache import cache
+    cache.init_app(app, config={
+        'CACHE_TYPE': settings.cache_type,
+        'CACHE_DEFAULT_TIMEOUT': 10,
+        'CACHE_REDIS_URL': settings.cache_redis_url,
+    })
+
     # Register blueprints
     from .routes import main_bp
     app.register_blueprint(main_bp)
 
-    # Create database tables (for development)
-    with app.app_context():
-        db.create_all()
+    # Build the Directions client and its connection pool before the first request
+    if warm_directions and settings.google_maps_api_key:
+        from .google_directions import get_directions_service
+        get_directions_service()
+
+    # Create database tables (for development); deployments run init_db.py
+    if settings.auto_create_tables:
+        with app.app_context():
+            db.create_all()
 
     return app
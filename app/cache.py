@@ -0,0 +1,9 @@
+"""
+Response cache for read-hot alert endpoints
+"""
+from flask_caching import Cache
+
+cache = Cache()
+
+# Cache key for GET /alerts
+ALERTS_LIST_KEY = 'alerts_list'
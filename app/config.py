@@ -0,0 +1,48 @@
+"""
+Application settings, read once from the environment at import time
+"""
+import os
+from dataclasses import dataclass
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """Environment configuration"""
+    
+    database_url: str
+    auto_create_tables: bool
+    cache_type: str
+    cache_redis_url: Optional[str]
+    google_maps_api_key: Optional[str]
+    twilio_account_sid: Optional[str]
+    twilio_auth_token: Optional[str]
+    twilio_phone_number: Optional[str]
+    twilio_notify_service_sid: Optional[str]
+    
+    @classmethod
+    def from_env(cls) -> 'Settings':
+        """Build settings from os.environ (and .env)"""
+        database_url = os.getenv('DATABASE_URL', 'sqlite:///punctual.db')
+        
+        # Render PostgreSQL uses 'postgres://' but SQLAlchemy needs 'postgresql://'
+        if database_url.startswith('postgres://'):
+            database_url = database_url.replace('postgres://', 'postgresql://', 1)
+        
+        return cls(
+            database_url=database_url,
+            auto_create_tables=os.getenv('AUTO_CREATE_TABLES') == '1',
+            cache_type=os.getenv('CACHE_TYPE', 'SimpleCache'),
+            cache_redis_url=os.getenv('CACHE_REDIS_URL'),
+            google_maps_api_key=os.getenv('GOOGLE_MAPS_API_KEY'),
+            twilio_account_sid=os.getenv('TWILIO_ACCOUNT_SID'),
+            twilio_auth_token=os.getenv('TWILIO_AUTH_TOKEN'),
+            twilio_phone_number=os.getenv('TWILIO_PHONE_NUMBER'),
+            twilio_notify_service_sid=os.getenv('TWILIO_NOTIFY_SERVICE_SID'),
+        )
+
+
+settings = Settings.from_env()
@@ -1,20 +1,130 @@
 """
 Google Directions API integration module
 """
-import os
+import functools
+import re
+import threading
 import googlemaps
+import requests
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
+from flask import has_app_context
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from typing import Dict, Optional, Tuple
+from .config import settings
+from .models import db, GeocodeCache
+
+
+# Shared read-only fallback for missing nested objects (avoids a new {} per lookup)
+_EMPTY: Dict = {}
+
+# Matches any HTML tag in Google's html_instructions (<b>, <div style=...>, ...);
+# block tags separate phrases, so they become a space instead of nothing
+_HTML_TAG = re.compile(r'<[^>]+>')
+_HTML_BLOCK_TAG = re.compile(r'</?(?:div|br|p)\b[^>]*>', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+
+# Directions API time parameter and trip direction for each target type:
+# the target time is the departure (+duration to arrival) or the arrival
+# (-duration to departure)
+_TARGET_TYPES = {
+    'DEPARTURE': ('departure_time', 1),
+    'ARRIVAL': ('arrival_time', -1),
+}
+
+# Route cache: target times are bucketed into 5-minute windows so repeated
+# lookups reuse the Google response while transit schedules stay fresh
+ROUTE_CACHE_TTL_SECONDS = 300
+_route_cache: TTLCache = TTLCache(maxsize=4096, ttl=ROUTE_CACHE_TTL_SECONDS)
+_route_cache_lock = threading.RLock()
+
+
+def _route_cache_key(origin: str, destination: str, target_type: str, target_time: datetime) -> Tuple:
+    """Build route cache key from resolved endpoints and time bucket"""
+    return (
+        origin,
+        destination,
+        target_type,
+        int(target_time.timestamp()) // ROUTE_CACHE_TTL_SECONDS
+    )
+
+
+def _strip_html(html: str) -> str:
+    """Convert Google's html_instructions to plain text"""
+    text = _HTML_TAG.sub('', _HTML_BLOCK_TAG.sub(' ', html))
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+def _normalize_place_text(text: str) -> str:
+    """Normalize free-form location text (case and whitespace)"""
+    return ' '.join(text.lower().split())
+
+
+def _load_place_id(query_text: str) -> Optional[str]:
+    """Read a persisted place ID (shared across workers)"""
+    if not has_app_context():
+        return None
+    
+    # Separate connection so the caller's session transaction is untouched
+    try:
+        with db.engine.connect() as conn:
+            return conn.execute(
+                db.select(GeocodeCache.place_id).where(GeocodeCache.query_text == query_text)
+            ).scalar()
+    except SQLAlchemyError:
+        return None  # Cache unavailable; fall back to the Geocoding API
+
+
+def _save_place_id(query_text: str, place_id: str) -> None:
+    """Persist a resolved place ID"""
+    if not has_app_context():
+        return
+    
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(
+                db.insert(GeocodeCache).values(query_text=query_text, place_id=place_id)
+            )
+    except IntegrityError:
+        pass  # Another worker stored it first
+    except SQLAlchemyError:
+        pass  # Cache unavailable; the place ID is still memoized in-process
+
+
+def cache_clear() -> None:
+    """Clear all cached routes and in-process place IDs"""
+    with _route_cache_lock:
+        _route_cache.clear()
+    if _directions_service is not None:
+        _directions_service._resolve_place.cache_clear()
 
 
 class DirectionsService:
     """Google Directions API service"""
     
     def __init__(self):
-        api_key = os.getenv('GOOGLE_MAPS_API_KEY')
+        api_key = settings.google_maps_api_key
         if not api_key:
             raise ValueError("GOOGLE_MAPS_API_KEY not set. Please check your .env file.")
-        self.client = googlemaps.Client(key=api_key)
+        
+        # Pooled session keeps TLS connections alive across API calls
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=50,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.2,
+                status_forcelist=[429, 500, 502, 503, 504]
+            )
+        )
+        session.mount('https://', adapter)
+        
+        self.client = googlemaps.Client(key=api_key, requests_session=session)
+        self._geocoding_enabled = True
+        self._resolve_place = functools.lru_cache(maxsize=2048)(self._lookup_place)
     
     def calculate_route(
         self,
@@ -42,59 +152,35 @@ class DirectionsService:
             }
         """
         try:
-            # Determine API call method based on target_type
-            if target_type == 'DEPARTURE':
-                # Departure time basis: when will they arrive if leaving at this time
-                directions = self.client.directions(
-                    origin=origin,
-                    destination=destination,
-                    mode="transit",  # Public transit
-                    departure_time=target_time,
-                    alternatives=False
-                )
-                
-                if not directions or len(directions) == 0:
-                    raise ValueError("No route found")
-                
-                route = directions[0]
-                leg = route['legs'][0]
-                
-                departure_time = target_time
-                duration_seconds = leg['duration']['value']
-                arrival_time = departure_time + timedelta(seconds=duration_seconds)
-                
-            else:  # ARRIVAL
-                # Arrival time basis: when must they leave to arrive at this time
-                directions = self.client.directions(
-                    origin=origin,
-                    destination=destination,
-                    mode="transit",
-                    arrival_time=target_time,
-                    alternatives=False
-                )
-                
-                if not directions or len(directions) == 0:
-                    raise ValueError("No route found")
-                
-                route = directions[0]
-                leg = route['legs'][0]
-                
-                arrival_time = target_time
-                duration_seconds = leg['duration']['value']
-                departure_time = arrival_time - timedelta(seconds=duration_seconds)
+            if target_type not in _TARGET_TYPES:
+                raise ValueError(f"Invalid target_type: {target_type} (expected DEPARTURE or ARRIVAL)")
             
-            # Distance information
-            distance_meters = leg['distance']['value']
+            # Resolve endpoints to place IDs so equivalent text shares a cache entry
+            origin = self._place_ref(origin)
+            destination = self._place_ref(destination)
             
-            # Extract step information (including transit details)
-            steps = self._extract_steps(leg['steps'])
+            key = _route_cache_key(origin, destination, target_type, target_time)
+            with _route_cache_lock:
+                route = _route_cache.get(key)
+            
+            if route is None:
+                route = self._fetch_route(origin, destination, target_type, target_time)
+                with _route_cache_lock:
+                    _route_cache[key] = route
+            
+            # Times are derived from the caller's target time, not cached
+            duration_seconds = route['duration_seconds']
+            _, direction = _TARGET_TYPES[target_type]
+            other_time = target_time + timedelta(seconds=direction * duration_seconds)
+            departure_time = min(target_time, other_time)
+            arrival_time = max(target_time, other_time)
             
             return {
                 'departure_time': departure_time,
                 'arrival_time': arrival_time,
                 'duration_seconds': duration_seconds,
-                'distance_meters': distance_meters,
-                'steps': steps,
+                'distance_meters': route['distance_meters'],
+                'steps': route['steps'],
                 'success': True
             }
             
@@ -109,6 +195,112 @@ class DirectionsService:
                 'error': f'Route calculation error: {str(e)}'
             }
     
+    def _place_ref(self, text: str) -> str:
+        """
+        Convert location text to a Directions API waypoint
+        
+        Args:
+            text: Location text (address or place name)
+        
+        Returns:
+            str: 'place_id:...' when resolvable, otherwise the normalized text
+        """
+        query_text = _normalize_place_text(text)
+        try:
+            place_id = self._resolve_place(query_text)
+        except (
+            googlemaps.exceptions.ApiError,
+            googlemaps.exceptions.TransportError,
+            googlemaps.exceptions.Timeout,
+        ):
+            place_id = None  # Not cached, retried on the next call
+        
+        return f'place_id:{place_id}' if place_id else query_text
+    
+    def _lookup_place(self, query_text: str) -> Optional[str]:
+        """
+        Resolve normalized location text to a Google place ID
+        
+        Checks the geocode_cache table before calling the Geocoding API.
+        Results, including permanent misses (no results, invalid request,
+        Geocoding API denied for the key), are memoized per process by
+        _resolve_place; temporary API errors raise so they are not.
+        
+        Args:
+            query_text: Normalized location text
+        
+        Returns:
+            str or None: Place ID, or None if the text could not be geocoded
+        """
+        place_id = _load_place_id(query_text)
+        if place_id:
+            return place_id
+        
+        if not self._geocoding_enabled:
+            return None
+        
+        try:
+            results = self.client.geocode(query_text)
+        except googlemaps.exceptions.ApiError as e:
+            if e.status == 'REQUEST_DENIED':
+                # Geocoding API not enabled for this key: stop calling it
+                self._geocoding_enabled = False
+                return None
+            if e.status == 'INVALID_REQUEST':
+                return None  # This text can never geocode; memoized as a miss
+            raise  # Temporary (OVER_QUERY_LIMIT, UNKNOWN_ERROR, ...): not memoized
+        
+        if not results:
+            return None
+        
+        place_id = results[0]['place_id']
+        _save_place_id(query_text, place_id)
+        return place_id
+    
+    def _fetch_route(
+        self,
+        origin: str,
+        destination: str,
+        target_type: str,
+        target_time: datetime
+    ) -> Dict:
+        """
+        Call Google Directions API for a transit route
+        
+        Args:
+            origin: Starting point (address or place name)
+            destination: Destination (address or place name)
+            target_type: 'DEPARTURE' or 'ARRIVAL'
+            target_time: User's target time
+        
+        Returns:
+            Dict: {
+                'duration_seconds': int,
+                'distance_meters': int,
+                'steps': List[Dict]
+            }
+        """
+        time_kwarg, _ = _TARGET_TYPES[target_type]
+        directions = self.client.directions(
+            origin=origin,
+            destination=destination,
+            mode="transit",  # Public transit
+            alternatives=False,
+            **{time_kwarg: target_time}
+        )
+        
+        if not directions or len(directions) == 0:
+            raise ValueError("No route found")
+        
+        leg = directions[0]['legs'][0]
+        
+        return {
+            'duration_seconds': leg['duration']['value'],
+            'distance_meters': leg['distance']['value'],
+            # Extract step information (including transit details)
+            'steps': self._extract_steps(leg['steps'])
+        }
+    
     def _extract_steps(self, steps: list) -> list:
         """
         Extract route step information (simplified)
@@ -119,45 +311,49 @@ class DirectionsService:
         Returns:
             List[Dict]: Simplified step information
         """
-        extracted = []
+        extracted = [None] * len(steps)
         
-        for step in steps:
+        for index, step in enumerate(steps):
+            get = step.get
             step_info = {
-                'travel_mode': step.get('travel_mode'),
-                'distance': step.get('distance', {}).get('text'),
-                'duration': step.get('duration', {}).get('text'),
-                'instructions': step.get('html_instructions', '').replace('<b>', '').replace('</b>', '')
+                'travel_mode': get('travel_mode'),
+                'distance': (get('distance') or _EMPTY).get('text'),
+                'duration': (get('duration') or _EMPTY).get('text'),
+                'instructions': _strip_html(get('html_instructions') or '')
             }
             
             # Add transit information if available
-            if 'transit_details' in step:
-                transit = step['transit_details']
-                step_info['transit_details'] = transit  # Store full transit details
+            transit = get('transit_details')
+            if transit:
+                line = transit.get('line') or _EMPTY
                 step_info['transit'] = {
-                    'type': transit.get('line', {}).get('vehicle', {}).get('type'),
-                    'line_name': transit.get('line', {}).get('name'),
-                    'line_short_name': transit.get('line', {}).get('short_name'),
-                    'departure_stop': transit.get('departure_stop', {}).get('name'),
-                    'arrival_stop': transit.get('arrival_stop', {}).get('name'),
+                    'type': (line.get('vehicle') or _EMPTY).get('type'),
+                    'line_name': line.get('name'),
+                    'line_short_name': line.get('short_name'),
+                    'departure_stop': (transit.get('departure_stop') or _EMPTY).get('name'),
+                    'arrival_stop': (transit.get('arrival_stop') or _EMPTY).get('name'),
                     'num_stops': transit.get('num_stops'),
                     'headsign': transit.get('headsign'),
-                    'departure_time': transit.get('departure_time', {}).get('value'),  # Unix timestamp
-                    'arrival_time': transit.get('arrival_time', {}).get('value'),  # Unix timestamp
+                    'departure_time': (transit.get('departure_time') or _EMPTY).get('value'),  # Unix timestamp
+                    'arrival_time': (transit.get('arrival_time') or _EMPTY).get('value'),  # Unix timestamp
                 }
             
-            extracted.append(step_info)
+            extracted[index] = step_info
         
         return extracted
 
 
 # Singleton instance
 _directions_service: Optional[DirectionsService] = None
+_directions_service_lock = threading.Lock()
 
 
 def get_directions_service() -> DirectionsService:
-    """Get DirectionsService singleton instance"""
+    """Get DirectionsService singleton instance (thread-safe)"""
     global _directions_service
     if _directions_service is None:
-        _directions_service = DirectionsService()
+        with _directions_service_lock:
+            if _directions_service is None:
+                _directions_service = DirectionsService()
     return _directions_service
 
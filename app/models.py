@@ -1,6 +1,6 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import BigInteger, String, Text, Integer, DateTime, Boolean
+from sqlalchemy import BigInteger, String, Text, Integer, DateTime, Boolean, text
 from sqlalchemy.sql import func
 import enum
 
@@ -31,12 +31,21 @@ class NotificationType(enum.Enum):
 class TransitAlert(db.Model):
     """Transit alert model with smart notifications"""
     __tablename__ = 'transit_alerts'
+    __table_args__ = (
+        # Due-notification scans (partial on PostgreSQL: only pending alerts)
+        db.Index('ix_alerts_wake', 'status', 'wake_up_sent', 'wake_up_time',
+                 postgresql_where=text("status = 'PENDING'")),
+        db.Index('ix_alerts_departure', 'status', 'departure_sent', 'rounded_departure_time',
+                 postgresql_where=text("status = 'PENDING'")),
+        db.Index('ix_alerts_transit', 'status', 'transit_sent', 'transit_notify_time',
+                 postgresql_where=text("status = 'PENDING'")),
+    )
 
     # Primary Key
     id = db.Column(Integer, primary_key=True, autoincrement=True)
 
     # User information
-    phone_number = db.Column(String(20), nullable=False, comment='Phone number with country code (+1)')
+    phone_number = db.Column(String(20), nullable=False, index=True, comment='Phone number with country code (+1)')
 
     # Route information
     origin_text = db.Column(Text, nullable=False, comment='Starting point (e.g., Calgary Tower)')
@@ -45,6 +54,7 @@ class TransitAlert(db.Model):
     # User's target time
     target_type = db.Column(String(20), nullable=False, comment='DEPARTURE or ARRIVAL')
     target_time = db.Column(DateTime(timezone=True), nullable=False, comment='User specified time')
+    utc_offset_minutes = db.Column(Integer, comment="UTC offset the user gave target_time in (times in SMS use it)")
 
     # Google API calculation results
     calculated_departure_time = db.Column(DateTime(timezone=True), comment='When to leave home')
@@ -60,42 +70,63 @@ class TransitAlert(db.Model):
     first_transit_stop_time = db.Column(DateTime(timezone=True), comment='When first transit arrives at stop')
     transit_notify_time = db.Column(DateTime(timezone=True), comment='3 minutes before transit arrives')
 
+    # Route details saved at calculation time (read by notification senders)
+    steps_json = db.Column(db.JSON, comment='Simplified route steps')
+    first_transit_json = db.Column(db.JSON, comment='First transit leg details')
+
     # Notification status flags
     wake_up_sent = db.Column(Boolean, default=False, comment='Wake up notification sent')
     departure_sent = db.Column(Boolean, default=False, comment='Departure notification sent')
     transit_sent = db.Column(Boolean, default=False, comment='Transit notification sent')
 
     # Overall status
-    status = db.Column(String(20), nullable=False, default='PENDING', comment='Overall alert status')
+    status = db.Column(String(20), nullable=False, default='PENDING', index=True, comment='Overall alert status')
 
     # Timestamps
     created_at = db.Column(DateTime(timezone=True), nullable=False, server_default=func.now())
     updated_at = db.Column(DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now())
 
+    # Columns exposed by to_dict() and the list endpoints
+    SERIALIZED_FIELDS = (
+        'id',
+        'phone_number',
+        'origin_text',
+        'destination_text',
+        'target_type',
+        'target_time',
+        'calculated_departure_time',
+        'calculated_arrival_time',
+        'total_duration_seconds',
+        'preparation_minutes',
+        'wake_up_time',
+        'rounded_departure_time',
+        'first_transit_stop_time',
+        'transit_notify_time',
+        'wake_up_sent',
+        'departure_sent',
+        'transit_sent',
+        'status',
+        'created_at',
+        'updated_at',
+    )
+
     def __repr__(self):
         return f'<TransitAlert {self.id}: {self.origin_text} → {self.destination_text}>'
 
+    @classmethod
+    def serialized_columns(cls) -> list:
+        """Column attributes for selecting serialized fields without ORM hydration"""
+        return [getattr(cls, field) for field in cls.SERIALIZED_FIELDS]
+
     def to_dict(self):
-        """Convert model to dictionary"""
-        return {
-            'id': self.id,
-            'phone_number': self.phone_number,
-            'origin_text': self.origin_text,
-            'destination_text': self.destination_text,
-            'target_type': self.target_type,
-            'target_time': self.target_time.isoformat() if self.target_time else None,
-            'calculated_departure_time': self.calculated_departure_time.isoformat() if self.calculated_departure_time else None,
-            'calculated_arrival_time': self.calculated_arrival_time.isoformat() if self.calculated_arrival_time else None,
-            'total_duration_seconds': self.total_duration_seconds,
-            'preparation_minutes': self.preparation_minutes,
-            'wake_up_time': self.wake_up_time.isoformat() if self.wake_up_time else None,
-            'rounded_departure_time': self.rounded_departure_time.isoformat() if self.rounded_departure_time else None,
-            'first_transit_stop_time': self.first_transit_stop_time.isoformat() if self.first_transit_stop_time else None,
-            'transit_notify_time': self.transit_notify_time.isoformat() if self.transit_notify_time else None,
-            'wake_up_sent': self.wake_up_sent,
-            'departure_sent': self.departure_sent,
-            'transit_sent': self.transit_sent,
-            'status': self.status,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
-        }
\ No newline at end of file
+        """Convert model to dictionary (datetimes are left for the JSON encoder)"""
+        return {field: getattr(self, field) for field in self.SERIALIZED_FIELDS}
+
+
+class GeocodeCache(db.Model):
+    """Resolved Google place IDs for location text (shared across workers)"""
+    __tablename__ = 'geocode_cache'
+
+    query_text = db.Column(Text, primary_key=True, comment='Normalized location text')
+    place_id = db.Column(String(255), nullable=False, comment='Google place ID')
+    created_at = db.Column(DateTime(timezone=True), nullable=False, server_default=func.now())
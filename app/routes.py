@@ -1,18 +1,42 @@
-from flask import Blueprint, request, jsonify
-from datetime import datetime
+import orjson
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from ciso8601 import parse_datetime
+from datetime import timezone
+from .cache import cache, ALERTS_LIST_KEY
 from .models import db, TransitAlert
 from .services import (
     calculate_and_update_route,
-    send_wake_up_notification,
-    send_departure_notification,
-    send_transit_notification,
+    send_wake_up_notification_by_id,
+    send_departure_notification_by_id,
+    send_transit_notification_by_id,
     cancel_alert,
-    get_pending_alerts
+    mark_notifications_sent,
+    pending_alert_filters
 )
+from .twilio_service import get_twilio_service
 
 main_bp = Blueprint("main", __name__)
 
 
+def stream_json_rows(stmt) -> Response:
+    """Stream rows of a column select as a JSON array, skipping ORM hydration"""
+    def generate():
+        yield b'['
+        rows = db.session.execute(stmt.execution_options(yield_per=500))
+        for index, row in enumerate(rows):
+            yield (b',' if index else b'') + orjson.dumps(dict(row._mapping))
+        yield b']'
+    
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def invalidate_alert_cache(alert_id: int = None) -> None:
+    """Drop cached alert responses after a write"""
+    cache.delete(ALERTS_LIST_KEY)
+    if alert_id is not None:
+        cache.delete_memoized(get_alert, alert_id)
+
+
 @main_bp.get("/")
 def home():
     return {"msg": "Punctual API - Smart Transit Alert Service"}
@@ -22,7 +46,7 @@ def home():
 def test_sms():
     """Send a test SMS to verify Twilio is working"""
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True)
         
         if not data or 'phone_number' not in data:
             return jsonify({"error": "phone_number is required"}), 400
@@ -30,7 +54,6 @@ def test_sms():
         phone_number = data['phone_number']
         message = data.get('message', '🧪 Test SMS from Punctual!\n\nIf you received this, Twilio is working correctly! ✅')
         
-        from .twilio_service import get_twilio_service
         twilio = get_twilio_service()
         
         result = twilio.send_sms(phone_number, message)
@@ -56,7 +79,9 @@ def test_sms():
 def create_alert():
     """Create new transit alert with automatic route calculation"""
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True)
+        if data is None:
+            return jsonify({"error": "Request body must be JSON"}), 400
         
         # Validate required fields
         required_fields = ['phone_number', 'origin_text', 'destination_text', 'target_type', 'target_time']
@@ -64,21 +89,32 @@ def create_alert():
             if field not in data:
                 return jsonify({"error": f"Missing required field: {field}"}), 400
         
+        # Parse once at the boundary and keep times in UTC from here on; the
+        # user's offset is kept so SMS times are shown in their local time
+        local_target_time = parse_datetime(data['target_time'])
+        if local_target_time.tzinfo is None:
+            local_target_time = local_target_time.astimezone()
+        target_time = local_target_time.astimezone(timezone.utc)
+        utc_offset = local_target_time.utcoffset()
+        
         # Create new alert
         alert = TransitAlert(
             phone_number=data['phone_number'],
             origin_text=data['origin_text'],
             destination_text=data['destination_text'],
             target_type=data['target_type'],
-            target_time=datetime.fromisoformat(data['target_time']),
+            target_time=target_time,
+            utc_offset_minutes=int(utc_offset.total_seconds()) // 60,
             preparation_minutes=data.get('preparation_minutes', 30)
         )
         
+        # Calculate route and notification times using Google Directions API,
+        # then insert the alert in one commit (saved even if calculation fails)
+        calculation_result = calculate_and_update_route(alert)
+        
         db.session.add(alert)
         db.session.commit()
-        
-        # Calculate route and notification times using Google Directions API
-        alert, calculation_result = calculate_and_update_route(alert.id)
+        invalidate_alert_cache(alert.id)
         
         response_data = alert.to_dict()
         
@@ -105,39 +141,63 @@ def create_alert():
 
 
 @main_bp.get("/alerts")
+@cache.cached(timeout=5, key_prefix=ALERTS_LIST_KEY)
 def get_alerts():
     """Get all alerts"""
-    alerts = TransitAlert.query.all()
-    return jsonify([alert.to_dict() for alert in alerts]), 200
+    # Buffered rather than streamed so the response can be cached
+    rows = db.session.execute(db.select(*TransitAlert.serialized_columns()))
+    return jsonify([dict(row._mapping) for row in rows]), 200
 
 
 @main_bp.get("/alerts/<int:alert_id>")
+@cache.memoize(timeout=10)
 def get_alert(alert_id):
     """Get specific alert"""
-    alert = TransitAlert.query.get_or_404(alert_id)
-    return jsonify(alert.to_dict()), 200
+    row = db.session.execute(
+        db.select(*TransitAlert.serialized_columns()).where(TransitAlert.id == alert_id)
+    ).first()
+    
+    if row is None:
+        return jsonify({"error": "Alert not found"}), 404
+    
+    return jsonify(dict(row._mapping)), 200
 
 
 @main_bp.put("/alerts/<int:alert_id>")
 def update_alert(alert_id):
     """Update alert information"""
     try:
-        alert = TransitAlert.query.get_or_404(alert_id)
-        data = request.get_json()
+        data = request.get_json(silent=True)
+        if data is None:
+            return jsonify({"error": "Request body must be JSON"}), 400
         
         # Updatable fields
         updatable_fields = [
             'status', 'preparation_minutes'
         ]
         
-        for field in updatable_fields:
-            if field in data:
-                setattr(alert, field, data[field])
+        changes = {field: data[field] for field in updatable_fields if field in data}
+        columns = TransitAlert.serialized_columns()
+        
+        # Single UPDATE ... RETURNING (or SELECT when nothing changes), no ORM load
+        if changes:
+            stmt = (
+                db.update(TransitAlert)
+                .where(TransitAlert.id == alert_id)
+                .values(**changes)
+                .returning(*columns)
+            )
+        else:
+            stmt = db.select(*columns).where(TransitAlert.id == alert_id)
+        
+        row = db.session.execute(stmt).first()
+        if row is None:
+            return jsonify({"error": "Alert not found"}), 404
         
-        alert.updated_at = datetime.utcnow()
         db.session.commit()
+        invalidate_alert_cache(alert_id)
         
-        return jsonify(alert.to_dict()), 200
+        return jsonify(dict(row._mapping)), 200
         
     except Exception as e:
         db.session.rollback()
@@ -148,11 +208,15 @@ def update_alert(alert_id):
 def recalculate_route(alert_id):
     """Recalculate route for existing alert"""
     try:
-        alert, calculation_result = calculate_and_update_route(alert_id)
+        alert = db.session.get(TransitAlert, alert_id)
         
         if not alert:
             return jsonify({"error": "Alert not found"}), 404
         
+        calculation_result = calculate_and_update_route(alert)
+        db.session.commit()
+        invalidate_alert_cache(alert_id)
+        
         response_data = alert.to_dict()
         
         # Add route calculation result
@@ -173,13 +237,18 @@ def recalculate_route(alert_id):
         return jsonify(response_data), 200
         
     except Exception as e:
+        db.session.rollback()
         return jsonify({"error": str(e)}), 400
 
 
 @main_bp.post("/alerts/<int:alert_id>/notify/wake-up")
 def notify_wake_up(alert_id):
     """Send wake up notification"""
-    result = send_wake_up_notification(alert_id)
+    result = send_wake_up_notification_by_id(alert_id)
+    if result.get('success'):
+        mark_notifications_sent('wake_up', [alert_id])
+        db.session.commit()
+    invalidate_alert_cache(alert_id)
     
     if result.get('success'):
         return jsonify(result), 200
@@ -190,7 +259,11 @@ def notify_wake_up(alert_id):
 @main_bp.post("/alerts/<int:alert_id>/notify/departure")
 def notify_departure(alert_id):
     """Send departure notification"""
-    result = send_departure_notification(alert_id)
+    result = send_departure_notification_by_id(alert_id)
+    if result.get('success'):
+        mark_notifications_sent('departure', [alert_id])
+        db.session.commit()
+    invalidate_alert_cache(alert_id)
     
     if result.get('success'):
         return jsonify(result), 200
@@ -201,7 +274,11 @@ def notify_departure(alert_id):
 @main_bp.post("/alerts/<int:alert_id>/notify/transit")
 def notify_transit(alert_id):
     """Send transit arrival notification"""
-    result = send_transit_notification(alert_id)
+    result = send_transit_notification_by_id(alert_id)
+    if result.get('success'):
+        mark_notifications_sent('transit', [alert_id])
+        db.session.commit()
+    invalidate_alert_cache(alert_id)
     
     if result.get('success'):
         return jsonify(result), 200
@@ -213,6 +290,7 @@ def notify_transit(alert_id):
 def cancel_alert_route(alert_id):
     """Cancel alert"""
     alert = cancel_alert(alert_id)
+    invalidate_alert_cache(alert_id)
     
     if alert:
         return jsonify(alert.to_dict()), 200
@@ -225,17 +303,24 @@ def get_pending_alerts_route():
     """Get pending alerts that need notifications"""
     notification_type = request.args.get('type')  # wake_up, departure, or transit
     
-    alerts = get_pending_alerts(notification_type)
-    return jsonify([alert.to_dict() for alert in alerts]), 200
+    stmt = db.select(*TransitAlert.serialized_columns()).where(
+        *pending_alert_filters(notification_type)
+    )
+    return stream_json_rows(stmt)
 
 
 @main_bp.delete("/alerts/<int:alert_id>")
 def delete_alert(alert_id):
     """Delete alert"""
     try:
-        alert = TransitAlert.query.get_or_404(alert_id)
-        db.session.delete(alert)
+        result = db.session.execute(
+            db.delete(TransitAlert).where(TransitAlert.id == alert_id)
+        )
+        if result.rowcount == 0:
+            return jsonify({"error": "Alert not found"}), 404
+        
         db.session.commit()
+        invalidate_alert_cache(alert_id)
         return jsonify({"message": "Alert deleted successfully"}), 200
         
     except Exception as e:
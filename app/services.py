@@ -1,39 +1,76 @@
 """
 Transit alert service logic with smart notifications
 """
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.orm import load_only
 from .models import db, TransitAlert
-from .google_directions import get_directions_service
-from .twilio_service import get_twilio_service
 
+_UTC = timezone.utc
+_fromtimestamp = datetime.fromtimestamp
 
-def round_to_quarter_hour(dt: datetime) -> datetime:
+# Quarter hour in seconds, and the offset that turns flooring into rounding
+# (minute 8 rounds up to 15, minute 53 to the next hour)
+QUARTER_HOUR = 15 * 60
+QUARTER_HOUR_ROUNDING = 7 * 60
+
+# Notification type -> sent flag column
+SENT_FLAGS = {
+    'wake_up': TransitAlert.wake_up_sent,
+    'departure': TransitAlert.departure_sent,
+    'transit': TransitAlert.transit_sent,
+}
+
+# Notification type -> time the notification is due
+NOTIFY_TIMES = {
+    'wake_up': TransitAlert.wake_up_time,
+    'departure': TransitAlert.rounded_departure_time,
+    'transit': TransitAlert.transit_notify_time,
+}
+
+# Only the columns the send_* functions read
+NOTIFY_COLUMNS = (
+    TransitAlert.id,
+    TransitAlert.phone_number,
+    TransitAlert.origin_text,
+    TransitAlert.destination_text,
+    TransitAlert.target_type,
+    TransitAlert.target_time,
+    TransitAlert.utc_offset_minutes,
+    TransitAlert.calculated_arrival_time,
+    TransitAlert.rounded_departure_time,
+    TransitAlert.steps_json,
+    TransitAlert.first_transit_json,
+    TransitAlert.wake_up_sent,
+    TransitAlert.departure_sent,
+    TransitAlert.transit_sent,
+)
+
+
+def _utcnow() -> datetime:
+    """Current time as an aware UTC datetime"""
+    return datetime.now(_UTC)
+
+
+def _as_utc(dt: datetime) -> datetime:
+    """Attach UTC to naive datetimes (SQLite returns stored times as naive UTC)"""
+    return dt.replace(tzinfo=_UTC) if dt.tzinfo is None else dt
+
+
+def format_local_time(alert: TransitAlert, dt: datetime) -> str:
     """
-    Round datetime to nearest quarter hour (0, 15, 30, 45 minutes)
+    Format a stored time for an SMS in the alert's original UTC offset
     
     Args:
-        dt: Datetime to round
+        alert: Alert the time belongs to
+        dt: Stored time (UTC)
     
     Returns:
-        Rounded datetime
+        str: Time like '08:30 AM'
     """
-    minute = dt.minute
-    
-    # Round to nearest 15-minute mark
-    if minute < 8:
-        rounded_minute = 0
-    elif minute < 23:
-        rounded_minute = 15
-    elif minute < 38:
-        rounded_minute = 30
-    elif minute < 53:
-        rounded_minute = 45
-    else:
-        # Round up to next hour
-        dt = dt + timedelta(hours=1)
-        rounded_minute = 0
-    
-    return dt.replace(minute=rounded_minute, second=0, microsecond=0)
+    dt = _as_utc(dt)
+    if alert.utc_offset_minutes is not None:
+        dt = dt.astimezone(timezone(timedelta(minutes=alert.utc_offset_minutes)))
+    return dt.strftime('%I:%M %p')
 
 
 def extract_first_transit_time(steps: list) -> tuple:
@@ -46,60 +83,56 @@ def extract_first_transit_time(steps: list) -> tuple:
     Returns:
         tuple: (transit_time: datetime or None, transit_info: dict or None)
     """
-    for step in steps:
-        if 'transit' in step:
-            transit_info = step['transit']
-            # Get departure time from transit info
-            dep_time_ts = transit_info.get('departure_time')
-            if dep_time_ts:
-                try:
-                    from datetime import timezone
-                    transit_time = datetime.fromtimestamp(dep_time_ts, tz=timezone.utc)
-                    return transit_time, transit_info
-                except:
-                    pass
-    
-    return None, None
-
-
-def calculate_and_update_route(alert_id: int):
+    transit_info = next(
+        (step['transit'] for step in steps
+         if 'transit' in step and step['transit'].get('departure_time')),
+        None
+    )
+    if transit_info is None:
+        return None, None
+    
+    return _fromtimestamp(transit_info['departure_time'], tz=_UTC), transit_info
+
+
+def calculate_and_update_route(alert: TransitAlert) -> dict:
     """
     Call Google Directions API and calculate all notification times
     
+    Updates the alert in place without flushing or committing, so a new
+    alert can be calculated and inserted in a single transaction.
+    
     Args:
-        alert_id: Alert ID
+        alert: Alert to update (persistent or not yet added)
     
     Returns:
-        Tuple[TransitAlert, Dict]: (updated alert, calculation result)
+        dict: Calculation result
     """
-    alert = TransitAlert.query.get(alert_id)
-    if not alert:
-        return None, {'success': False, 'error': 'Alert not found'}
-    
     try:
         # Call Google Directions API
+        from .google_directions import get_directions_service
         directions_service = get_directions_service()
         result = directions_service.calculate_route(
             origin=alert.origin_text,
             destination=alert.destination_text,
             target_type=alert.target_type,
-            target_time=alert.target_time
+            target_time=_as_utc(alert.target_time)
         )
         
         if not result.get('success'):
-            return alert, result
+            return result
         
         # Save Google API results
         alert.calculated_departure_time = result['departure_time']
         alert.calculated_arrival_time = result['arrival_time']
         alert.total_duration_seconds = result['duration_seconds']
         
-        # Calculate rounded departure time (0, 15, 30, 45 min)
-        alert.rounded_departure_time = round_to_quarter_hour(result['departure_time'])
+        # Calculate rounded departure time (0, 15, 30, 45 min) on epoch seconds
+        rounded_ts = (int(result['departure_time'].timestamp()) + QUARTER_HOUR_ROUNDING) // QUARTER_HOUR * QUARTER_HOUR
         
         # Calculate wake up time (departure - preparation time)
         prep_minutes = alert.preparation_minutes or 30
-        alert.wake_up_time = alert.rounded_departure_time - timedelta(minutes=prep_minutes)
+        alert.rounded_departure_time = _fromtimestamp(rounded_ts, _UTC)
+        alert.wake_up_time = _fromtimestamp(rounded_ts - prep_minutes * 60, _UTC)
         
         # Extract first transit arrival time
         first_transit_time, transit_info = extract_first_transit_time(result.get('steps', []))
@@ -108,195 +141,329 @@ def calculate_and_update_route(alert_id: int):
             # Notify 3 minutes before transit arrives
             alert.transit_notify_time = first_transit_time - timedelta(minutes=3)
         
-        alert.updated_at = datetime.utcnow()
-        db.session.commit()
+        # Keep route details for the notification senders
+        alert.steps_json = result.get('steps')
+        alert.first_transit_json = transit_info
         
         # Add transit info to result
         if transit_info:
             result['first_transit'] = transit_info
         
-        return alert, result
+        return result
         
     except Exception as e:
-        return alert, {
+        return {
             'success': False,
             'error': f'Route calculation error: {str(e)}'
         }
 
 
-def send_wake_up_notification(alert_id: int) -> dict:
+def build_wake_up_message(alert: TransitAlert) -> str:
+    """Build an alert's wake up SMS body"""
+    from .twilio_service import format_wake_up_message
+    departure_time = format_local_time(alert, alert.rounded_departure_time)
+    return format_wake_up_message(departure_time, alert.destination_text)
+
+
+class NoTransitInfoError(ValueError):
+    """An alert's route has no transit leg to announce"""
+
+
+def _route_details(alert: TransitAlert) -> tuple:
+    """
+    Get an alert's stored route steps and first transit leg
+    
+    Alerts saved before route details were stored have none, so their
+    route is recalculated and the details are set on the alert for the
+    caller to save (see save_route_details). If that fails, the steps
+    are empty and the transit leg is unknown.
+    
+    Args:
+        alert: Alert to read
+    
+    Returns:
+        tuple: (steps: list, transit_info: dict or None)
+    """
+    if alert.steps_json is None:
+        try:
+            from .google_directions import get_directions_service
+            result = get_directions_service().calculate_route(
+                origin=alert.origin_text,
+                destination=alert.destination_text,
+                target_type=alert.target_type,
+                target_time=_as_utc(alert.target_time)
+            )
+            if result.get('success'):
+                steps = result.get('steps', [])
+                alert.steps_json = steps
+                alert.first_transit_json = extract_first_transit_time(steps)[1]
+        except Exception:
+            pass
+    
+    return alert.steps_json or [], alert.first_transit_json
+
+
+def build_departure_message(alert: TransitAlert) -> str:
+    """Build an alert's departure SMS body from its stored route"""
+    from .twilio_service import format_departure_message
+    arrival_time = format_local_time(alert, alert.calculated_arrival_time)
+    steps, _ = _route_details(alert)
+    return format_departure_message(alert.destination_text, arrival_time, steps)
+
+
+def build_transit_message(alert: TransitAlert) -> str:
+    """
+    Build an alert's transit arrival SMS body from its first transit leg
+    
+    Raises NoTransitInfoError when the route has no transit leg or it is
+    unknown, so no made-up arrival time is ever sent.
+    """
+    from .twilio_service import format_transit_arrival_message
+    # First transit leg saved by calculate_and_update_route
+    _, transit_info = _route_details(alert)
+    if transit_info is None:
+        raise NoTransitInfoError('No transit information found')
+    return format_transit_arrival_message(transit_info, minutes_until=3)
+
+
+def send_wake_up_notification(alert: TransitAlert) -> dict:
     """
     Send wake up notification via Twilio
     
+    Does not flag the notification as sent; callers do that with
+    mark_notifications_sent once the send succeeds.
+    
     Args:
-        alert_id: Alert ID
+        alert: Alert to notify (already loaded)
     
     Returns:
         dict: Send result
     """
-    alert = TransitAlert.query.get(alert_id)
-    if not alert:
-        return {'success': False, 'error': 'Alert not found'}
-    
     if alert.wake_up_sent:
         return {'success': False, 'error': 'Wake up notification already sent'}
     
     try:
-        twilio = get_twilio_service()
-        departure_time = alert.rounded_departure_time.strftime('%I:%M %p')
-        
-        result = twilio.send_wake_up_notification(
-            to_number=alert.phone_number,
-            departure_time=departure_time,
-            destination=alert.destination_text
-        )
+        message = build_wake_up_message(alert)
         
-        if result.get('success'):
-            alert.wake_up_sent = True
-            db.session.commit()
-        
-        return result
+        from .twilio_service import get_twilio_service
+        return get_twilio_service().send_sms(alert.phone_number, message)
         
     except Exception as e:
         return {'success': False, 'error': str(e)}
 
 
-def send_departure_notification(alert_id: int) -> dict:
+def send_departure_notification(alert: TransitAlert) -> dict:
     """
     Send departure notification via Twilio
     
+    Does not flag the notification as sent; callers do that with
+    mark_notifications_sent once the send succeeds.
+    
     Args:
-        alert_id: Alert ID
+        alert: Alert to notify (already loaded)
     
     Returns:
         dict: Send result
     """
-    alert = TransitAlert.query.get(alert_id)
-    if not alert:
-        return {'success': False, 'error': 'Alert not found'}
-    
     if alert.departure_sent:
         return {'success': False, 'error': 'Departure notification already sent'}
     
     try:
-        # Get route steps again for notification
-        directions_service = get_directions_service()
-        result = directions_service.calculate_route(
-            origin=alert.origin_text,
-            destination=alert.destination_text,
-            target_type=alert.target_type,
-            target_time=alert.target_time
-        )
+        message = build_departure_message(alert)
         
-        twilio = get_twilio_service()
-        arrival_time = alert.calculated_arrival_time.strftime('%I:%M %p')
-        
-        sms_result = twilio.send_departure_notification(
-            to_number=alert.phone_number,
-            destination=alert.destination_text,
-            arrival_time=arrival_time,
-            steps=result.get('steps', [])
-        )
-        
-        if sms_result.get('success'):
-            alert.departure_sent = True
-            db.session.commit()
-        
-        return sms_result
+        from .twilio_service import get_twilio_service
+        return get_twilio_service().send_sms(alert.phone_number, message)
         
     except Exception as e:
         return {'success': False, 'error': str(e)}
 
 
-def send_transit_notification(alert_id: int) -> dict:
+def send_transit_notification(alert: TransitAlert) -> dict:
     """
     Send transit arrival notification via Twilio
     
+    Does not flag the notification as sent; callers do that with
+    mark_notifications_sent once the send succeeds.
+    
     Args:
-        alert_id: Alert ID
+        alert: Alert to notify (already loaded)
     
     Returns:
         dict: Send result
     """
-    alert = TransitAlert.query.get(alert_id)
-    if not alert:
-        return {'success': False, 'error': 'Alert not found'}
-    
     if alert.transit_sent:
         return {'success': False, 'error': 'Transit notification already sent'}
     
     try:
-        # Get route to find transit info
-        directions_service = get_directions_service()
-        result = directions_service.calculate_route(
-            origin=alert.origin_text,
-            destination=alert.destination_text,
-            target_type=alert.target_type,
-            target_time=alert.target_time
-        )
-        
-        _, transit_info = extract_first_transit_time(result.get('steps', []))
-        
-        if not transit_info:
-            return {'success': False, 'error': 'No transit information found'}
-        
-        twilio = get_twilio_service()
-        sms_result = twilio.send_transit_arrival_notification(
-            to_number=alert.phone_number,
-            transit_info=transit_info,
-            minutes_until=3
-        )
-        
-        if sms_result.get('success'):
-            alert.transit_sent = True
-            db.session.commit()
+        message = build_transit_message(alert)
         
-        return sms_result
+        from .twilio_service import get_twilio_service
+        return get_twilio_service().send_sms(alert.phone_number, message)
         
     except Exception as e:
         return {'success': False, 'error': str(e)}
 
 
-def get_pending_alerts(notification_type: str = None) -> list:
+def _due_conditions(now: datetime) -> dict:
     """
-    Get pending alerts that need notifications
+    Build the "notification due" condition for each notification type
+    
+    Args:
+        now: Current UTC time
+    
+    Returns:
+        Dict of notification type -> SQLAlchemy condition
+    """
+    return {
+        name: db.and_(sent_flag == False, NOTIFY_TIMES[name] <= now)
+        for name, sent_flag in SENT_FLAGS.items()
+    }
+
+
+def pending_alert_filters(notification_type: str = None) -> list:
+    """
+    Build filter conditions for pending alerts that need notifications
     
     Args:
         notification_type: 'wake_up', 'departure', or 'transit'
     
     Returns:
-        List of alerts
+        List of SQLAlchemy filter conditions
     """
-    query = TransitAlert.query.filter_by(status='PENDING')
+    filters = [TransitAlert.status == 'PENDING']
     
-    now = datetime.utcnow()
+    due = _due_conditions(_utcnow()).get(notification_type)
+    if due is not None:
+        filters.append(due)
     
-    if notification_type == 'wake_up':
-        query = query.filter(
-            TransitAlert.wake_up_sent == False,
-            TransitAlert.wake_up_time <= now
-        )
-    elif notification_type == 'departure':
-        query = query.filter(
-            TransitAlert.departure_sent == False,
-            TransitAlert.rounded_departure_time <= now
-        )
-    elif notification_type == 'transit':
-        query = query.filter(
-            TransitAlert.transit_sent == False,
-            TransitAlert.transit_notify_time <= now
+    return filters
+
+
+def get_due_alerts() -> list:
+    """
+    Get pending alerts with any notification due, using a single query
+    
+    Returns:
+        List of (alert, due notification types) tuples
+    """
+    conditions = _due_conditions(_utcnow())
+    stmt = db.select(
+        TransitAlert,
+        *(condition.label(f'{name}_due') for name, condition in conditions.items())
+    ).where(
+        TransitAlert.status == 'PENDING',
+        db.or_(*conditions.values())
+    ).options(load_only(*NOTIFY_COLUMNS))
+    
+    return [
+        (row[0], [name for name, due in zip(conditions, row[1:]) if due])
+        for row in db.session.execute(stmt)
+    ]
+
+
+def get_notification_times(until: datetime) -> list:
+    """
+    Get the distinct times of unsent notifications due up to a cutoff
+    
+    Args:
+        until: Latest notification time to include (UTC)
+    
+    Returns:
+        List of notification times, including ones already past
+    """
+    stmt = db.union(*(
+        db.select(NOTIFY_TIMES[name].label('notify_time')).where(
+            TransitAlert.status == 'PENDING',
+            sent_flag == False,
+            NOTIFY_TIMES[name] <= until
         )
+        for name, sent_flag in SENT_FLAGS.items()
+    ))
+    return db.session.execute(stmt).scalars().all()
+
+
+def _send_by_id(send, alert_id: int) -> dict:
+    """Load an alert by ID and pass it to a send_* function"""
+    alert = db.session.get(TransitAlert, alert_id, options=[load_only(*NOTIFY_COLUMNS)])
+    if not alert:
+        return {'success': False, 'error': 'Alert not found'}
+    return send(alert)
+
+
+def send_wake_up_notification_by_id(alert_id: int) -> dict:
+    """Send wake up notification for an alert ID"""
+    return _send_by_id(send_wake_up_notification, alert_id)
+
+
+def send_departure_notification_by_id(alert_id: int) -> dict:
+    """Send departure notification for an alert ID"""
+    return _send_by_id(send_departure_notification, alert_id)
+
+
+def send_transit_notification_by_id(alert_id: int) -> dict:
+    """Send transit arrival notification for an alert ID"""
+    return _send_by_id(send_transit_notification, alert_id)
+
+
+def save_route_details(alerts: list):
+    """
+    Save route details recalculated by _route_details with a single UPDATE
     
-    return query.all()
+    The caller commits.
+    
+    Args:
+        alerts: Alerts whose steps_json/first_transit_json were filled in
+    """
+    if alerts:
+        db.session.execute(db.update(TransitAlert), [
+            {
+                'id': alert.id,
+                'steps_json': alert.steps_json,
+                'first_transit_json': alert.first_transit_json,
+            }
+            for alert in alerts
+        ])
 
 
-def mark_alert_complete(alert_id: int):
-    """Mark alert as complete if all notifications sent"""
-    alert = TransitAlert.query.get(alert_id)
-    if alert and alert.wake_up_sent and alert.departure_sent and alert.transit_sent:
-        alert.status = 'SENT'
-        db.session.commit()
-    return alert
+def mark_notifications_sent(notification_type: str, alert_ids: list):
+    """
+    Flag a notification as sent for many alerts with a single UPDATE
+    
+    The caller commits, so several types can share one transaction.
+    
+    Args:
+        notification_type: 'wake_up', 'departure', or 'transit'
+        alert_ids: IDs of alerts whose notification was sent
+    """
+    if alert_ids:
+        db.session.execute(
+            db.update(TransitAlert)
+            .where(TransitAlert.id.in_(alert_ids))
+            .values({SENT_FLAGS[notification_type]: True})
+        )
+
+
+def mark_alerts_complete(alert_ids: list):
+    """
+    Mark alerts as complete if all notifications sent, with a single UPDATE
+    
+    The caller commits.
+    
+    Args:
+        alert_ids: IDs of alerts to check
+    """
+    if alert_ids:
+        db.session.execute(
+            db.update(TransitAlert)
+            .where(
+                TransitAlert.id.in_(alert_ids),
+                TransitAlert.status == 'PENDING',
+                TransitAlert.wake_up_sent == True,
+                TransitAlert.departure_sent == True,
+                TransitAlert.transit_sent == True
+            )
+            .values(status='SENT')
+        )
 
 
 def cancel_alert(alert_id: int):
@@ -304,6 +471,5 @@ def cancel_alert(alert_id: int):
     alert = TransitAlert.query.get(alert_id)
     if alert:
         alert.status = 'CANCELLED'
-        alert.updated_at = datetime.utcnow()
         db.session.commit()
     return alert
@@ -1,18 +1,94 @@
 """
 Twilio SMS notification service
 """
-import os
-from twilio.rest import Client
+import json
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
+from .config import settings
+
+# SMS message templates
+WAKE_UP_TEMPLATE = (
+    "⏰ Good morning! Time to wake up!\n\n"
+    "You need to leave at {departure_time} to reach {destination} on time.\n"
+    "Start getting ready!"
+)
+DEPARTURE_TEMPLATE = (
+    "🚪 Time to leave!\n\n"
+    "Destination: {destination}\n"
+    "Arrival: {arrival_time}\n\n"
+    "Route:\n{route_summary}\n\n"
+    "Have a safe trip!"
+)
+TRANSIT_ARRIVAL_TEMPLATE = (
+    "🚌 Transit Alert!\n\n"
+    "{line_name} is arriving at {stop_name} in {minutes_until} minutes.\n"
+    "Head to the stop now!"
+)
+TRANSIT_STEP_TEMPLATE = "🚌 {line_short_name}: {departure_stop} → {arrival_stop}"
+WALK_STEP_TEMPLATE = "🚶 Walk {distance}"
+
+# Route steps shown in the departure message
+ROUTE_SUMMARY_STEPS = 3
+
+# Concurrent recipients in send_sms_batch; each send is a blocking HTTPS call
+MAX_SEND_WORKERS = 16
+
+# Seconds before a Twilio API request is abandoned
+TWILIO_TIMEOUT_SECONDS = 10
+
+
+def _format_step(step: dict) -> Optional[str]:
+    """Format one route step as a summary line (None for other travel modes)"""
+    transit = step.get('transit')
+    if transit is not None:
+        return TRANSIT_STEP_TEMPLATE.format(
+            line_short_name=transit.get('line_short_name', 'Transit'),
+            departure_stop=transit.get('departure_stop', ''),
+            arrival_stop=transit.get('arrival_stop', '')
+        )
+    if step['travel_mode'] == 'WALKING':
+        return WALK_STEP_TEMPLATE.format(distance=step.get('distance', ''))
+    return None
+
+
+def format_wake_up_message(departure_time: str, destination: str) -> str:
+    """Build the wake up message"""
+    return WAKE_UP_TEMPLATE.format(
+        departure_time=departure_time,
+        destination=destination
+    )
+
+
+def format_departure_message(destination: str, arrival_time: str, steps: list) -> str:
+    """Build the departure message with a summary of the first route steps"""
+    route_summary = "\n".join(
+        filter(None, map(_format_step, steps[:ROUTE_SUMMARY_STEPS]))
+    )
+    return DEPARTURE_TEMPLATE.format(
+        destination=destination,
+        arrival_time=arrival_time,
+        route_summary=route_summary
+    )
+
+
+def format_transit_arrival_message(transit_info: dict, minutes_until: int = 3) -> str:
+    """Build the transit arriving soon message"""
+    return TRANSIT_ARRIVAL_TEMPLATE.format(
+        line_name=transit_info.get('line_short_name', 'Your transit'),
+        stop_name=transit_info.get('departure_stop', 'the stop'),
+        minutes_until=minutes_until
+    )
 
 
 class TwilioService:
     """Twilio SMS service for sending notifications"""
     
     def __init__(self):
-        account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-        auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-        self.from_number = os.getenv('TWILIO_PHONE_NUMBER')
+        account_sid = settings.twilio_account_sid
+        auth_token = settings.twilio_auth_token
+        self.from_number = settings.twilio_phone_number
         
         if not all([account_sid, auth_token, self.from_number]):
             raise ValueError(
@@ -20,7 +96,23 @@ class TwilioService:
                 "TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_PHONE_NUMBER"
             )
         
-        self.client = Client(account_sid, auth_token)
+        # Imported here so processes that never send skip the Twilio SDK
+        from requests.adapters import HTTPAdapter
+        from twilio.http.http_client import TwilioHttpClient
+        from twilio.rest import Client
+        
+        # Pooled session keeps TLS connections alive across sends, with a
+        # host pool each for api. and notify.twilio.com and a connection for
+        # every send_sms_batch worker; the timeout keeps a hung request from
+        # stalling a whole batch
+        http_client = TwilioHttpClient(pool_connections=True, timeout=TWILIO_TIMEOUT_SECONDS)
+        http_client.session.mount('https://', HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=MAX_SEND_WORKERS
+        ))
+        
+        self.client = Client(account_sid, auth_token, http_client=http_client)
+        self.notify_service_sid = settings.twilio_notify_service_sid
     
     def send_sms(self, to_number: str, message: str) -> dict:
         """
@@ -52,6 +144,89 @@ class TwilioService:
                 'error': str(e)
             }
     
+    def send_sms_batch(self, messages: list) -> list:
+        """
+        Send many SMS messages, batching where Twilio allows it
+        
+        With a Notify service configured, a body shared by several
+        recipients goes out as one Notify request. Everything else is sent
+        concurrently, one worker per recipient so each recipient's
+        messages keep their order.
+        
+        Args:
+            messages: List of (to_number, message) tuples
+        
+        Returns:
+            list: Send result for each message, in input order
+        """
+        results = [None] * len(messages)
+        
+        # Only recipients with a single message here can go through Notify
+        # without being reordered against their other messages
+        by_body = defaultdict(list)
+        if self.notify_service_sid:
+            recipient_counts = Counter(to_number for to_number, _ in messages)
+            for i, (to_number, body) in enumerate(messages):
+                if recipient_counts[to_number] == 1:
+                    by_body[body].append(i)
+        
+        for body, indexes in by_body.items():
+            if len(indexes) > 1:
+                result = self._send_notify([messages[i][0] for i in indexes], body)
+                for i in indexes:
+                    results[i] = result
+        
+        by_recipient = defaultdict(list)
+        for i, (to_number, _) in enumerate(messages):
+            if results[i] is None:
+                by_recipient[to_number].append(i)
+        
+        def send_in_order(indexes):
+            for i in indexes:
+                results[i] = self.send_sms(*messages[i])
+        
+        if len(by_recipient) == 1:
+            send_in_order(*by_recipient.values())
+        elif by_recipient:
+            workers = min(MAX_SEND_WORKERS, len(by_recipient))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(send_in_order, by_recipient.values()))
+        
+        return results
+    
+    def _send_notify(self, to_numbers: list, message: str) -> dict:
+        """
+        Send one message to several recipients with a single Notify request
+        
+        Args:
+            to_numbers: Recipient phone numbers
+            message: Message content
+        
+        Returns:
+            dict: {'success': bool, 'notification_sid': str or 'error': str}
+        """
+        try:
+            notification = self.client.notify.v1.services(
+                self.notify_service_sid
+            ).notifications.create(
+                body=message,
+                to_binding=[
+                    json.dumps({'binding_type': 'sms', 'address': to_number})
+                    for to_number in to_numbers
+                ]
+            )
+            
+            return {
+                'success': True,
+                'notification_sid': notification.sid
+            }
+            
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+    
     def send_wake_up_notification(self, to_number: str, departure_time: str, destination: str) -> dict:
         """
         Send wake up notification
@@ -64,11 +239,7 @@ class TwilioService:
         Returns:
             dict: Result of SMS send
         """
-        message = (
-            f"⏰ Good morning! Time to wake up!\n\n"
-            f"You need to leave at {departure_time} to reach {destination} on time.\n"
-            f"Start getting ready!"
-        )
+        message = format_wake_up_message(departure_time, destination)
         return self.send_sms(to_number, message)
     
     def send_departure_notification(
@@ -90,25 +261,7 @@ class TwilioService:
         Returns:
             dict: Result of SMS send
         """
-        # Build route summary
-        route_summary = []
-        for step in steps[:3]:  # Show first 3 steps
-            if 'transit' in step:
-                transit = step['transit']
-                route_summary.append(
-                    f"🚌 {transit.get('line_short_name', 'Transit')}: "
-                    f"{transit.get('departure_stop', '')} → {transit.get('arrival_stop', '')}"
-                )
-            elif step['travel_mode'] == 'WALKING':
-                route_summary.append(f"🚶 Walk {step.get('distance', '')}")
-        
-        message = (
-            f"🚪 Time to leave!\n\n"
-            f"Destination: {destination}\n"
-            f"Arrival: {arrival_time}\n\n"
-            f"Route:\n" + "\n".join(route_summary) +
-            f"\n\nHave a safe trip!"
-        )
+        message = format_departure_message(destination, arrival_time, steps)
         return self.send_sms(to_number, message)
     
     def send_transit_arrival_notification(
@@ -128,25 +281,21 @@ class TwilioService:
         Returns:
             dict: Result of SMS send
         """
-        line_name = transit_info.get('line_short_name', 'Your transit')
-        stop_name = transit_info.get('departure_stop', 'the stop')
-        
-        message = (
-            f"🚌 Transit Alert!\n\n"
-            f"{line_name} is arriving at {stop_name} in {minutes_until} minutes.\n"
-            f"Head to the stop now!"
-        )
+        message = format_transit_arrival_message(transit_info, minutes_until)
         return self.send_sms(to_number, message)
 
 
 # Singleton instance
 _twilio_service: Optional[TwilioService] = None
+_twilio_service_lock = threading.Lock()
 
 
 def get_twilio_service() -> TwilioService:
-    """Get TwilioService singleton instance"""
+    """Get TwilioService singleton instance (thread-safe)"""
     global _twilio_service
     if _twilio_service is None:
-        _twilio_service = TwilioService()
+        with _twilio_service_lock:
+            if _twilio_service is None:
+                _twilio_service = TwilioService()
     return _twilio_service
 
@@ -5,13 +5,52 @@ This script creates or recreates database tables.
 from app import create_app
 from app.models import db
 
+# Indexes superseded by newer ones in app/models.py, or no longer used
+OBSOLETE_INDEXES = (
+    'ix_pending_wake',
+    'ix_pending_departure',
+    'ix_pending_transit',
+    'ix_transit_alerts_target_epoch',
+    'ix_status_target',
+)
+
+def add_missing_columns():
+    """Add model columns missing from existing tables (create_all() skips them)"""
+    inspector = db.inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                conn.execute(db.text(
+                    f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                ))
+                print(f"  Added column {table.name}.{column.name}")
+
+
 def init_database():
     """Initialize database"""
-    app = create_app()
+    app = create_app(warm_directions=False, statement_timeout=False)
     
     with app.app_context():
         print("Creating database tables...")
         db.create_all()
+        
+        # create_all() skips existing tables, so add any columns and indexes
+        # they are missing
+        add_missing_columns()
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(db.engine, checkfirst=True)
+        with db.engine.begin() as conn:
+            for name in OBSOLETE_INDEXES:
+                conn.execute(db.text(f'DROP INDEX IF EXISTS {name}'))
         print("✅ Database tables created successfully!")
         
         # Print table list
@@ -21,7 +60,7 @@ def init_database():
 
 def drop_database():
     """Drop database tables (Warning!)"""
-    app = create_app()
+    app = create_app(warm_directions=False, statement_timeout=False)
     
     response = input("⚠️  Are you sure you want to drop all tables? (yes/no): ")
     if response.lower() == 'yes':
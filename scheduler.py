@@ -2,105 +2,167 @@
 Notification scheduler
 Automatically sends wake up, departure, and transit notifications at the right time
 """
+import threading
+from datetime import datetime, timedelta, timezone
 from apscheduler.schedulers.background import BackgroundScheduler
 from app import create_app
 from app.services import (
-    get_pending_alerts,
-    send_wake_up_notification,
-    send_departure_notification,
-    send_transit_notification,
-    mark_alert_complete
+    get_due_alerts,
+    get_notification_times,
+    NoTransitInfoError,
+    build_wake_up_message,
+    build_departure_message,
+    build_transit_message,
+    save_route_details,
+    mark_notifications_sent,
+    mark_alerts_complete
 )
+from app.models import db
+from app.twilio_service import get_twilio_service
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# How often upcoming notifications are planned, and how far ahead
+PLAN_INTERVAL_SECONDS = 30
+PLAN_LOOKAHEAD = timedelta(seconds=2 * PLAN_INTERVAL_SECONDS)
+
+# Built once and shared by every tick, so the engine and its pool are reused
+app = create_app(warm_directions=False)
+
+scheduler = BackgroundScheduler(timezone=timezone.utc)
+
+# Held while sending so overlapping send jobs cannot notify twice
+_send_lock = threading.Lock()
+
+# Notification type -> (log label, message builder), in send order
+NOTIFIERS = {
+    'wake_up': ('Wake up', build_wake_up_message),
+    'departure': ('Departure', build_departure_message),
+    'transit': ('Transit', build_transit_message),
+}
 
-def check_and_send_wake_up_notifications():
-    """Check and send wake up notifications"""
-    app = create_app()
-    with app.app_context():
-        alerts = get_pending_alerts('wake_up')
-        logger.info(f"Found {len(alerts)} wake up notifications to send")
-        
-        for alert in alerts:
-            try:
-                result = send_wake_up_notification(alert.id)
-                if result.get('success'):
-                    logger.info(f"✅ Wake up notification sent for alert {alert.id}")
-                else:
-                    logger.error(f"❌ Failed to send wake up for alert {alert.id}: {result.get('error')}")
-            except Exception as e:
-                logger.error(f"❌ Error sending wake up for alert {alert.id}: {e}")
+
+def check_and_send_all():
+    """Check and send all due notifications, unless a send is already running"""
+    # Skip instead of queueing: a blocked job would hold an executor thread,
+    # and the next planning run re-queries whatever is still due
+    if not _send_lock.acquire(blocking=False):
+        logger.info("Send already in progress, skipping this run")
+        return
+    try:
+        send_due_notifications()
+    finally:
+        _send_lock.release()
 
 
-def check_and_send_departure_notifications():
-    """Check and send departure notifications"""
-    app = create_app()
+def send_due_notifications():
+    """Send all due notifications with a single query"""
     with app.app_context():
-        alerts = get_pending_alerts('departure')
-        logger.info(f"Found {len(alerts)} departure notifications to send")
-        
-        for alert in alerts:
+        due_alerts = get_due_alerts()
+    logger.info(f"Found {len(due_alerts)} alerts with notifications to send")
+    
+    # Build every due message first so the tick goes out as one batch;
+    # one alert's notifications stay in send order
+    keys, messages = [], []
+    # Alerts whose route details were recalculated while building, and
+    # alerts with no transit leg to announce
+    rerouted, no_transit_ids = [], []
+    for alert, due_types in due_alerts:
+        had_route = alert.steps_json is not None
+        for notification_type in due_types:
+            label, build = NOTIFIERS[notification_type]
             try:
-                result = send_departure_notification(alert.id)
-                if result.get('success'):
-                    logger.info(f"✅ Departure notification sent for alert {alert.id}")
-                else:
-                    logger.error(f"❌ Failed to send departure for alert {alert.id}: {result.get('error')}")
+                messages.append((alert.phone_number, build(alert)))
+                keys.append((alert.id, notification_type))
+            except NoTransitInfoError:
+                logger.warning(f"⚠️ No transit information for alert {alert.id}, skipping transit notification")
+                no_transit_ids.append(alert.id)
             except Exception as e:
-                logger.error(f"❌ Error sending departure for alert {alert.id}: {e}")
+                logger.error(f"❌ Error sending {label.lower()} for alert {alert.id}: {e}")
+        if not had_route and alert.steps_json is not None:
+            rerouted.append(alert)
+    
+    # Skipped transit notifications count as sent so they are not retried
+    sent_ids = {notification_type: [] for notification_type in NOTIFIERS}
+    sent_ids['transit'].extend(no_transit_ids)
+    
+    if messages:
+        try:
+            results = get_twilio_service().send_sms_batch(messages)
+        except Exception as e:
+            logger.error(f"❌ Error sending notifications: {e}")
+            results = [{'success': False, 'error': str(e)}] * len(messages)
+        
+        for (alert_id, notification_type), result in zip(keys, results):
+            label = NOTIFIERS[notification_type][0]
+            if result.get('success'):
+                logger.info(f"✅ {label} notification sent for alert {alert_id}")
+                sent_ids[notification_type].append(alert_id)
+            else:
+                logger.error(f"❌ Failed to send {label.lower()} for alert {alert_id}: {result.get('error')}")
+    
+    if not rerouted and not any(sent_ids.values()):
+        return
+    
+    # Save recalculated routes and flag everything sent this tick in one
+    # transaction
+    with app.app_context():
+        try:
+            save_route_details(rerouted)
+            for notification_type, alert_ids in sent_ids.items():
+                mark_notifications_sent(notification_type, alert_ids)
+            # Mark alerts as complete if all notifications sent
+            mark_alerts_complete(sent_ids['transit'])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"❌ Error flagging sent notifications {sent_ids}: {e}")
 
 
-def check_and_send_transit_notifications():
-    """Check and send transit arrival notifications"""
-    app = create_app()
+def plan_notifications():
+    """Schedule a one-shot send job at each upcoming notification time"""
+    now = datetime.now(timezone.utc)
     with app.app_context():
-        alerts = get_pending_alerts('transit')
-        logger.info(f"Found {len(alerts)} transit notifications to send")
-        
-        for alert in alerts:
-            try:
-                result = send_transit_notification(alert.id)
-                if result.get('success'):
-                    logger.info(f"✅ Transit notification sent for alert {alert.id}")
-                    # Mark alert as complete if all notifications sent
-                    mark_alert_complete(alert.id)
-                else:
-                    logger.error(f"❌ Failed to send transit for alert {alert.id}: {result.get('error')}")
-            except Exception as e:
-                logger.error(f"❌ Error sending transit for alert {alert.id}: {e}")
+        notify_times = get_notification_times(now + PLAN_LOOKAHEAD)
+    
+    run_dates = set()
+    for notify_time in notify_times:
+        if notify_time.tzinfo is None:
+            notify_time = notify_time.replace(tzinfo=timezone.utc)
+        # Anything already due runs right away
+        run_dates.add(max(notify_time, now))
+    
+    for run_date in run_dates:
+        scheduler.add_job(
+            check_and_send_all,
+            'date',
+            run_date=run_date,
+            id=f'notify_{run_date.timestamp():.0f}',
+            replace_existing=True,
+            misfire_grace_time=None
+        )
+    logger.info(f"Planned {len(run_dates)} notification runs")
 
 
 def start_scheduler():
     """Start the notification scheduler"""
-    scheduler = BackgroundScheduler()
-    
-    # Check every 30 seconds for notifications
-    scheduler.add_job(
-        check_and_send_wake_up_notifications,
-        'interval',
-        seconds=30,
-        id='wake_up_check'
-    )
-    
-    scheduler.add_job(
-        check_and_send_departure_notifications,
-        'interval',
-        seconds=30,
-        id='departure_check'
-    )
-    
+    # Sends run as one-shot jobs at each notification time; the planning
+    # job only looks ahead for new ones. Overlapping or missed planning
+    # runs collapse into one instead of queueing up
     scheduler.add_job(
-        check_and_send_transit_notifications,
+        plan_notifications,
         'interval',
-        seconds=30,
-        id='transit_check'
+        seconds=PLAN_INTERVAL_SECONDS,
+        id='plan_check',
+        max_instances=1,
+        coalesce=True,
+        next_run_time=datetime.now(timezone.utc)
     )
     
     scheduler.start()
-    logger.info("🚀 Notification scheduler started! Checking every 30 seconds...")
+    logger.info(f"🚀 Notification scheduler started! Planning every {PLAN_INTERVAL_SECONDS} seconds...")
     
     return scheduler
 